@@ -5,29 +5,44 @@ Streamlit web interface
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import copy
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 import folium
 from streamlit_folium import st_folium
-from dotenv import load_dotenv
-from config import METRO_COST, BIKE_PROVIDERS, GEOVELO_ENDPOINT, NAVITIA_ENDPOINT
-import json
-
-# Paris boundary polygon
-PARIS_BOUNDARY = {
-    "type": "Feature",
-    "geometry": {
-        "type": "Polygon",
-        "coordinates": [[[2.3198871747441,48.90045978209],[2.3851496429397,48.902007785215],[2.394906293421,48.898444039523],[2.3988455271816,48.887109095072],[2.4132702557262,48.872892145992],[2.4163411302989,48.849233783552],[2.4122456125626,48.834538914673],[2.4221386362435,48.835797660955],[2.4281301699852,48.841528392473],[2.447699326814,48.844818443355],[2.4634383121686,48.842089485269],[2.4675819883673,48.833133318793],[2.4626960627524,48.819059770564],[2.4384475102742,48.818232447877],[2.406031823401,48.827615470779],[2.3909392530738,48.826078980076],[2.363946550191,48.816314210034],[2.3318980606376,48.817010929642],[2.2921959226619,48.82714160912],[2.2790519306533,48.832489952145],[2.2727931901868,48.827920084226],[2.2551442384175,48.834809549369],[2.2506124417162,48.845554851211],[2.2242191058804,48.853516917557],[2.2317363597469,48.86906858161],[2.2584671711142,48.880387263086],[2.2774870298138,48.877968320853],[2.2915068524977,48.8894718708],[2.3198871747441,48.90045978209]]]
-    },
-    "properties": {"code": "75", "nom": "Paris"}
-}
+from config import (
+    METRO_COST, SHORT_PASS_MINUTES, BIKE_PROVIDERS, PARIS_BOUNDARY_LATLON, PARIS_EDGE_START, PARIS_EDGE_END,
+    GEOVELO_ENDPOINT, GEOVELO_PARAMS, GEOVELO_BIKE_DETAILS, NAVITIA_ENDPOINT, ROUTE_SIMPLIFY_TOLERANCE,
+    MAP_TILES, MAP_TILES_ATTR, API_WORKERS,
+    OPTION_PROVIDER, OPTION_NAME, OPTION_UNLOCK, OPTION_PER_MINUTE, OPTION_MINUTES,
+    OPTION_COST, OPTION_TRIPS, OPTION_OVERAGE, OPTION_IS_BUNDLE, OPTION_IS_TRIP_PASS,
+    OPTION_RATE, OPTION_TRIP_COST, OPTION_REMAINING_TYPE, OPTION_PASS_MINUTES
+)
+from fast_polyline import decode_polyline
 
 # Load API key - try Streamlit secrets first, then fall back to .env
-try:
-    API_KEY = st.secrets["PRIM_API_KEY"]
-except:
-    load_dotenv()
-    API_KEY = os.getenv('PRIM_API_KEY')
+@st.cache_resource
+def load_api_key():
+    """Resolve the PRIM API key once per server process instead of on every rerun"""
+    try:
+        return st.secrets["PRIM_API_KEY"]
+    except (KeyError, FileNotFoundError):  # missing key, or no secrets.toml
+        from dotenv import load_dotenv
+        load_dotenv()
+        return os.getenv('PRIM_API_KEY')
+
+API_KEY = load_api_key()
+
+GEOVELO_HEADERS = {
+    "Content-Type": "application/json",
+    "apikey": API_KEY
+}
 
 # Initialize session state for map selections
 if 'origin' not in st.session_state:
@@ -60,76 +75,120 @@ Interested in collaborating on something similar? [Reach out on LinkedIn!](https
 """)
 
 # Helper functions
-def calculate_all_bike_costs(duration_minutes, provider):
-    """Calculate all pricing options for a provider
+@st.cache_resource
+def get_http_session():
+    """Shared HTTP session, so API connections (and TLS handshakes) are reused across calls and reruns"""
+    session = requests.Session()
+    # Also retry idempotent requests on transient gateway errors, but never after a read
+    # timeout - a hung API call would otherwise hold a shared worker for several timeouts
+    retries = Retry(total=2, read=0, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=API_WORKERS, max_retries=retries)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": "ParisMetroBikeComparison/1.0"})
+    return session
+
+@st.cache_resource
+def get_executor():
+    """Worker pool for the concurrent API calls, shared by all sessions and sized so
+    simultaneous comparisons do not wait on each other"""
+    return ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api")
+
+def round_coords(coords):
+    """Round a (lat, lon) pair to ~1 m so nearby clicks share cached API results"""
+    return (round(coords[0], 5), round(coords[1], 5))
+
+def price_options(duration_minutes):
+    """Pricing kernel - cost and remaining allowance of every option for one trip
     
-    Returns: list of dicts with pricing info
+    Pure array math over the flattened pricing tables in config, with no Python
+    objects involved, so it stays cheap per call and could be JIT-compiled as is.
+    Returns: (costs, remaining) arrays aligned with PRICING_OPTIONS
     """
-    import math
-    
-    pricing = BIKE_PROVIDERS[provider]
-    options = []
+    fits = duration_minutes <= OPTION_MINUTES
+    extra_minutes = np.maximum(0, duration_minutes - OPTION_MINUTES)
     
     # Per-minute pricing
-    if pricing["per_minute"] is not None:
-        cost = pricing["unlock"] + (duration_minutes * pricing["per_minute"])
+    costs = OPTION_UNLOCK + duration_minutes * OPTION_PER_MINUTE
+    
+    # Voi, Dott, Lime - pass bundles with carryover: prorate the pass if the trip fits,
+    # otherwise charge marginal minutes at the per-minute rate
+    bundle_costs = np.where(fits, duration_minutes * OPTION_RATE, OPTION_COST + extra_minutes * OPTION_PER_MINUTE)
+    costs = np.where(OPTION_IS_BUNDLE, bundle_costs, costs)
+    
+    # Velib' - effective cost per trip plus 30-minute overage blocks
+    trip_costs = OPTION_TRIP_COST + np.ceil(extra_minutes / 30) * OPTION_OVERAGE
+    costs = np.where(OPTION_IS_TRIP_PASS, trip_costs, costs)
+    
+    remaining = np.where(OPTION_IS_TRIP_PASS, OPTION_TRIPS - 1, np.where(fits, OPTION_MINUTES - duration_minutes, 0))
+    
+    return costs, remaining
+
+def calculate_all_bike_costs(duration_minutes):
+    """Calculate all pricing options for every provider
+    
+    Returns: list of dicts with pricing info, tagged with the provider
+    """
+    costs, remaining = price_options(duration_minutes)
+    
+    options = []
+    for i, (cost, left) in enumerate(zip(costs.tolist(), remaining.tolist())):
+        remaining_type = OPTION_REMAINING_TYPE[i]
+        if remaining_type is None:
+            left = None
+        elif remaining_type == "trips":
+            left = int(left)
         options.append({
-            "name": "Per-minute",
+            "name": OPTION_NAME[i],
             "cost": cost,
-            "remaining": None,
-            "remaining_type": None
+            "remaining": left,
+            "remaining_type": remaining_type,
+            "minutes": OPTION_PASS_MINUTES[i],
+            "provider": OPTION_PROVIDER[i]
         })
     
-    # Pass options
-    if provider == "Velib'":
-        # Velib' special handling
-        for pass_option in pricing["passes"]:
-            overage_blocks = 0
-            if duration_minutes > pass_option["minutes"]:
-                overage_minutes = duration_minutes - pass_option["minutes"]
-                overage_blocks = math.ceil(overage_minutes / 30)
-            
-            if pass_option["type"] == "single":
-                # Ticket V - single trip
-                cost = pass_option["cost"] + (overage_blocks * pass_option["overage_per_30min"])
-                options.append({
-                    "name": pass_option["name"],
-                    "cost": cost,
-                    "remaining": 0,
-                    "remaining_type": "trips"
-                })
-            else:
-                # 24h Pass - effective cost per trip
-                cost_per_trip = pass_option["cost"] / pass_option["trips"]
-                cost = cost_per_trip + (overage_blocks * pass_option["overage_per_30min"])
-                options.append({
-                    "name": pass_option["name"],
-                    "cost": cost,
-                    "remaining": pass_option["trips"] - 1,  # 4 trips left
-                    "remaining_type": "trips"
-                })
-    else:
-        # Voi, Dott, Lime - pass bundles with carryover
-        for pass_option in pricing["passes"]:
-            if duration_minutes <= pass_option["minutes"]:
-                # Trip fits in pass - prorate cost
-                cost_per_minute = pass_option["cost"] / pass_option["minutes"]
-                cost = duration_minutes * cost_per_minute
-                remaining = pass_option["minutes"] - duration_minutes
-            else:
-                # Trip exceeds pass - charge marginal minutes at per-minute rate
-                cost = pass_option["cost"] + ((duration_minutes - pass_option["minutes"]) * pricing["per_minute"])
-                remaining = 0
-            
-            options.append({
-                "name": f"{pass_option['minutes']} min pass",
-                "cost": cost,
-                "remaining": remaining,
-                "remaining_type": "minutes"
-            })
-    
     return options
 
+def swap_lonlat(coords):
+    """Convert GeoJSON [lon, lat] pairs to the [lat, lon] order folium expects"""
+    return [[c[1], c[0]] for c in coords]
+
+def simplify_route(points, tolerance=ROUTE_SIMPLIFY_TOLERANCE):
+    """Ramer-Douglas-Peucker simplification of a (lat, lon) route, keeping both endpoints
+    
+    Iterative, with the point-to-chord distances of each span computed as one array
+    operation. Returns: the kept points as a list of [lat, lon] lists
+    """
+    pts = np.asarray(points, dtype=np.float64)
+    if len(pts) < 3:
+        return pts.tolist()
+    
+    keep = np.zeros(len(pts), dtype=bool)
+    keep[0] = keep[-1] = True
+    
+    spans = [(0, len(pts) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        
+        chord = pts[end] - pts[start]
+        offsets = pts[start + 1:end] - pts[start]
+        chord_length = np.hypot(chord[0], chord[1])
+        if chord_length > 0:
+            distances = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / chord_length
+        else:  # closed loop - measure from the shared endpoint
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.append((start, split))
+            spans.append((split, end))
+    
+    return pts[keep].tolist()
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
 def get_metro_journey(from_coords, to_coords):
     """Get metro journey from Navitia API"""
     url = f"{NAVITIA_ENDPOINT}/journeys"
@@ -139,201 +198,310 @@ def get_metro_journey(from_coords, to_coords):
     }
     headers = {"apikey": API_KEY}
     
-    try:
-        response = requests.get(url, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data.get('journeys'):
-            journey = data['journeys'][0]
-            duration_sec = journey.get('duration', 0)
-            transfers = journey.get('nb_transfers', 0)
-            
-            # Extract route sections for visualization
-            sections = journey.get('sections', [])
-            
-            # Calculate time breakdown
-            walking_time = 0
-            transfer_time = 0
-            public_transport_time = 0
-            waiting_time = 0
-            
-            origin_station = None
-            destination_station = None
+    response = get_http_session().get(url, params=params, headers=headers, timeout=30)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    if data.get('journeys'):
+        journey = data['journeys'][0]
+        duration_sec = journey.get('duration', 0)
+        transfers = journey.get('nb_transfers', 0)
+        
+        sections = journey.get('sections', [])
+        
+        # Slim route sections for visualization - only the type, the [lat, lon] points
+        # and the line code are kept, so session state holds no raw Navitia payload
+        route_sections = []
+        
+        # Calculate time breakdown
+        walking_time = 0
+        transfer_time = 0
+        public_transport_time = 0
+        waiting_time = 0
+        
+        origin_station = None
+        destination_station = None
+        
+        for section in sections:
+            section_duration = section.get('duration', 0)
+            section_type = section.get('type')
             
-            for section in sections:
-                section_duration = section.get('duration', 0)
-                section_type = section.get('type')
-                
-                if section_type == 'street_network':
-                    walking_time += section_duration
-                elif section_type == 'transfer':
-                    transfer_time += section_duration
-                elif section_type == 'public_transport':
-                    public_transport_time += section_duration
-                    # Get origin station if first public transport section
-                    if not origin_station and section.get('from'):
-                        origin_station = section['from'].get('name', 'Unknown')
-                    # Get destination station (last public transport section)
-                    if section.get('to'):
-                        destination_station = section['to'].get('name', 'Unknown')
-                elif section_type == 'waiting':
-                    waiting_time += section_duration
+            # Swap GeoJSON lon/lat to folium lat/lon once, so reruns reuse the cached result
+            geojson = section.get('geojson')
+            if geojson and geojson.get('coordinates'):
+                route_sections.append({
+                    "type": section_type,
+                    "coords": swap_lonlat(geojson['coordinates']),
+                    "line": section.get('display_informations', {}).get('code', 'Metro')
+                })
             
-            return {
-                "duration_min": duration_sec / 60,
-                "duration_sec": duration_sec,
-                "transfers": transfers,
-                "cost": METRO_COST,
-                "sections": sections,
-                "raw_journey": journey,
-                "walking_time": walking_time,
-                "transfer_time": transfer_time,
-                "public_transport_time": public_transport_time,
-                "waiting_time": waiting_time,
-                "origin_station": origin_station,
-                "destination_station": destination_station
-            }
-    except Exception as e:
-        st.error(f"Metro API error: {e}")
+            if section_type == 'street_network':
+                walking_time += section_duration
+            elif section_type == 'transfer':
+                transfer_time += section_duration
+            elif section_type == 'public_transport':
+                public_transport_time += section_duration
+                # Get origin station if first public transport section
+                if not origin_station and section.get('from'):
+                    origin_station = section['from'].get('name', 'Unknown')
+                # Get destination station (last public transport section)
+                if section.get('to'):
+                    destination_station = section['to'].get('name', 'Unknown')
+            elif section_type == 'waiting':
+                waiting_time += section_duration
+        
+        return {
+            "duration_min": duration_sec / 60,
+            "duration_sec": duration_sec,
+            "transfers": transfers,
+            "cost": METRO_COST,
+            "sections": route_sections,
+            "sections_key": hashlib.blake2b(orjson.dumps(route_sections), digest_size=16).hexdigest(),
+            "walking_time": walking_time,
+            "transfer_time": transfer_time,
+            "public_transport_time": public_transport_time,
+            "waiting_time": waiting_time,
+            "origin_station": origin_station,
+            "destination_station": destination_station
+        }
     
     return None
 
-def get_bike_journey(from_coords, to_coords):
-    """Get e-bike journey from Geovelo API"""
-    url = GEOVELO_ENDPOINT
-    params = {
-        "instructions": "false",
-        "elevations": "false",
-        "geometry": "true",
-        "single_result": "true"
-    }
-    headers = {
-        "Content-Type": "application/json",
-        "apikey": API_KEY
-    }
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def get_geovelo_journey(from_coords, to_coords, mode, bike_details=None):
+    """Get a journey from Geovelo API for one transport mode ("BIKE" or "PEDESTRIAN")
+    
+    bike_details is only sent for bike journeys.
+    """
     payload = {
         "waypoints": [
             {"latitude": from_coords[0], "longitude": from_coords[1], "title": "Start"},
             {"latitude": to_coords[0], "longitude": to_coords[1], "title": "End"}
         ],
-        "bikeDetails": {
-            "profile": "MEDIAN",
-            "bikeType": "BSS",
-            "eBike": True
-        },
-        "transportModes": ["BIKE"]
+        "transportModes": [mode]
     }
+    if bike_details:
+        payload["bikeDetails"] = bike_details
     
-    try:
-        response = requests.post(url, json=payload, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        if isinstance(data, list) and len(data) > 0:
-            route = data[0]
-            duration_sec = route.get('duration', 0)
-            distance_m = route.get('distances', {}).get('total', 0)
-            
-            # Extract geometry from sections (not top level!)
-            geometry = ''
-            sections = route.get('sections', [])
-            if sections:
-                # Get geometry from the first BIKE section
-                for section in sections:
-                    if section.get('transportMode') == 'BIKE':
-                        geometry = section.get('geometry', '')
-                        break
-            
-            return {
-                "duration_min": duration_sec / 60,
-                "duration_sec": duration_sec,
-                "distance_km": distance_m / 1000,
-                "geometry": geometry
-            }
-    except Exception as e:
-        st.error(f"E-Bike API error: {e}")
+    response = get_http_session().post(
+        GEOVELO_ENDPOINT, json=payload, params=GEOVELO_PARAMS, headers=GEOVELO_HEADERS, timeout=30
+    )
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    if isinstance(data, list) and len(data) > 0:
+        route = data[0]
+        duration_sec = route.get('duration', 0)
+        distance_m = route.get('distances', {}).get('total', 0)
+        
+        # Extract geometry from sections (not top level!)
+        geometry = ''
+        sections = route.get('sections', [])
+        if sections:
+            # Get geometry from the first section of the requested mode
+            for section in sections:
+                if section.get('transportMode') == mode:
+                    geometry = section.get('geometry') or ''
+                    break
+        
+        # Decode and simplify the route here, once per cached journey, rather than on every
+        # rerun - session state then holds the (lat, lon) points instead of the encoded string
+        coords = []
+        if geometry:
+            try:
+                coords = simplify_route(decode_polyline(geometry))
+            except (ValueError, RuntimeError):  # malformed polyline (NumPy decoder / pypolyline)
+                pass
+        
+        return {
+            "duration_min": duration_sec / 60,
+            "duration_sec": duration_sec,
+            "distance_km": distance_m / 1000,
+            "coords": coords,
+            "route_key": hashlib.blake2b(geometry.encode(), digest_size=16).hexdigest()
+        }
     
     return None
 
+# Persisted to disk so restarts do not re-query Nominatim (1 request/s usage policy);
+# disk caches ignore ttl, which is fine as place coordinates hardly ever change
+@st.cache_data(persist="disk", max_entries=512, show_spinner=False)
+def search_address(query):
+    """Look up a normalized address query with Nominatim (cached)"""
+    url = "https://nominatim.openstreetmap.org/search"
+    params = {
+        "q": query + ", Paris, France",
+        "format": "json",
+        "limit": 1
+    }
+    
+    response = get_http_session().get(url, params=params, timeout=10)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    if data and len(data) > 0:
+        result = data[0]
+        return [float(result['lat']), float(result['lon'])], result.get('display_name', query)
+    else:
+        return None, None
+
 def geocode_address(address):
     """Geocode an address to coordinates using Nominatim"""
     try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            "q": address + ", Paris, France",
-            "format": "json",
-            "limit": 1
-        }
-        headers = {
-            "User-Agent": "ParisMetroBikeComparison/1.0"
-        }
-        
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data and len(data) > 0:
-            result = data[0]
-            return [float(result['lat']), float(result['lon'])], result.get('display_name', address)
-        else:
-            return None, None
+        # Normalize so "Louvre" and " louvre " share a cache entry
+        return search_address(address.strip().lower())
     except Exception as e:
         st.error(f"Geocoding error: {e}")
         return None, None
 
-def get_walking_journey(from_coords, to_coords):
-    """Get walking journey from Geovelo API"""
-    url = GEOVELO_ENDPOINT
-    params = {
-        "instructions": "false",
-        "elevations": "false",
-        "geometry": "true",
-        "single_result": "true"
-    }
-    headers = {
-        "Content-Type": "application/json",
-        "apikey": API_KEY
-    }
-    payload = {
-        "waypoints": [
-            {"latitude": from_coords[0], "longitude": from_coords[1], "title": "Start"},
-            {"latitude": to_coords[0], "longitude": to_coords[1], "title": "End"}
-        ],
-        "transportModes": ["PEDESTRIAN"]
-    }
+def in_paris(lat, lon):
+    """Check whether a point lies inside the Paris boundary
     
-    try:
-        response = requests.post(url, json=payload, params=params, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        if isinstance(data, list) and len(data) > 0:
-            route = data[0]
-            duration_sec = route.get('duration', 0)
-            distance_m = route.get('distances', {}).get('total', 0)
+    Even-odd ray casting, with the crossings of all boundary edges tested at once.
+    """
+    lat1, lon1 = PARIS_EDGE_START[:, 0], PARIS_EDGE_START[:, 1]
+    lat2, lon2 = PARIS_EDGE_END[:, 0], PARIS_EDGE_END[:, 1]
+    straddles = (lat1 > lat) != (lat2 > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):  # horizontal edges never straddle
+        crossing_lon = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+    return bool(np.count_nonzero(straddles & (lon < crossing_lon)) % 2)
+
+def trip_view(from_coords, to_coords):
+    """Center and [[south, west], [north, east]] bounds of a trip for the result map"""
+    center = ((from_coords[0] + to_coords[0]) / 2, (from_coords[1] + to_coords[1]) / 2)
+    bounds = (
+        (min(from_coords[0], to_coords[0]), min(from_coords[1], to_coords[1])),
+        (max(from_coords[0], to_coords[0]), max(from_coords[1], to_coords[1]))
+    )
+    return center, bounds
+
+@st.cache_resource
+def build_base_map():
+    """Build the selection map with the Paris boundary (once per server process)"""
+    m = folium.Map(
+        location=[48.8566, 2.3522],  # Center of Paris
+        zoom_start=12,
+        tiles=MAP_TILES,
+        attr=MAP_TILES_ATTR,
+        prefer_canvas=True
+    )
+    
+    # Add Paris boundary - a plain polygon from the precomputed lat/lon ring skips the
+    # GeoJson style mapping and feature-dict serialization done on every render
+    folium.Polygon(
+        PARIS_BOUNDARY_LATLON,
+        color='red',
+        weight=2,
+        dash_array='5, 5',
+        fill=False
+    ).add_to(m)
+    
+    return m
+
+@st.cache_resource(max_entries=32)
+def build_results_map(from_coords, to_coords, center, bounds, routes_key, _metro_sections, _bike, _walking):
+    """Build and render the result map, cached per trip and route geometry
+    
+    The metro, e-bike and walking routes are one FeatureGroup each on a single map, toggled
+    with a LayerControl. routes_key identifies the routes, which are not hashed themselves.
+    Returns: (map HTML, displayed) - displayed maps "metro", "metro_walking", "bike" and
+    "walking" to whether that route had geometry to draw
+    """
+    # prefer_canvas draws all vector layers into one canvas rather than an SVG node per line
+    results_map = folium.Map(
+        location=center,
+        zoom_start=13,
+        tiles=MAP_TILES,
+        attr=MAP_TILES_ATTR,
+        prefer_canvas=True
+    )
+    
+    # Origin and destination stay on the map whichever layers are shown
+    trip_layer = folium.FeatureGroup(name="Trip", control=False)
+    
+    folium.CircleMarker(
+        from_coords,
+        radius=8,
+        color='green',
+        fill=True,
+        fill_opacity=1,
+        popup="Origin"
+    ).add_to(trip_layer)
+    
+    folium.CircleMarker(
+        to_coords,
+        radius=8,
+        color='red',
+        fill=True,
+        fill_opacity=1,
+        popup="Destination"
+    ).add_to(trip_layer)
+    
+    trip_layer.add_to(results_map)
+    
+    # Add metro route with walking sections
+    metro_layer = folium.FeatureGroup(name="Metro")
+    metro_displayed = False
+    walking_segments = []
+    if _metro_sections:
+        for section in _metro_sections:
+            section_type = section['type']
             
-            # Extract geometry from sections (not top level!)
-            geometry = ''
-            sections = route.get('sections', [])
-            if sections:
-                # Get geometry from the first PEDESTRIAN section
-                for section in sections:
-                    if section.get('transportMode') == 'PEDESTRIAN':
-                        geometry = section.get('geometry', '')
-                        break
+            # Display public transport sections (purple)
+            if section_type == 'public_transport':
+                coords = section['coords']
+                if coords:
+                    folium.PolyLine(
+                        coords,
+                        color='purple',
+                        weight=6,
+                        opacity=0.9,
+                        popup=f"Line {section['line']}"
+                    ).add_to(metro_layer)
+                    
+                    metro_displayed = True
             
-            return {
-                "duration_min": duration_sec / 60,
-                "duration_sec": duration_sec,
-                "distance_km": distance_m / 1000,
-                "geometry": geometry,
-                "cost": 0  # Walking is free!
-            }
-    except Exception as e:
-        st.error(f"Walking API error: {e}")
+            # Collect walking sections (green) - they share one style and popup
+            elif section_type == 'street_network' or section_type == 'transfer':
+                coords = section['coords']
+                if coords:
+                    walking_segments.append(coords)
     
-    return None
+    # Draw all walking sections as a single multi-segment line, one Leaflet layer
+    metro_walking_displayed = bool(walking_segments)
+    if metro_walking_displayed:
+        folium.PolyLine(
+            walking_segments,
+            color='green',
+            weight=4,
+            opacity=0.7,
+            dash_array='5, 5',
+            popup="Walking"
+        ).add_to(metro_layer)
+    
+    metro_layer.add_to(results_map)
+    
+    displayed = {"metro": metro_displayed, "metro_walking": metro_walking_displayed}
+    
+    # Add e-bike and walking routes
+    for key, route, label, color in (("bike", _bike, "E-Bike", 'blue'), ("walking", _walking, "Walking", 'orange')):
+        route_layer = folium.FeatureGroup(name=label)
+        displayed[key] = bool(route and route['coords'])
+        if displayed[key]:
+            folium.PolyLine(
+                route['coords'],
+                color=color,
+                weight=6,
+                opacity=0.9,
+                popup=f"{label}: {route['distance_km']:.2f} km"
+            ).add_to(route_layer)
+        route_layer.add_to(results_map)
+    
+    folium.LayerControl(collapsed=False).add_to(results_map)
+    
+    results_map.fit_bounds(bounds)
+    
+    return results_map.get_root().render(), displayed
 
 # Main app interface - Map Selection
 st.subheader("📍 Select Origin and Destination")
@@ -369,45 +537,45 @@ with st.expander("🔍 Search by Address", expanded=False):
 
 st.markdown("**Or click on the map:** First click = origin, second click = destination")
 
-# Create the selection map
-m = folium.Map(
-    location=[48.8566, 2.3522],  # Center of Paris
-    zoom_start=12,
-    tiles="OpenStreetMap"
-)
+# Create the selection map from a copy of the cached base map - st_folium attaches
+# the marker layer to the map it is given, so the cached instance must stay clean
+m = copy.deepcopy(build_base_map())
+markers = folium.FeatureGroup(name="Markers")
 
-# Add Paris boundary
-folium.GeoJson(
-    PARIS_BOUNDARY,
-    name="Paris Boundary",
-    style_function=lambda x: {
-        'fillColor': 'transparent',
-        'color': 'red',
-        'weight': 2,
-        'dashArray': '5, 5'
-    }
-).add_to(m)
-
-# Add origin marker if set
+# Add origin marker if set - plain circle markers, which need no icon element or popup
+# and keep the marker layer sent with every rerun small
 if st.session_state.origin:
-    folium.Marker(
+    folium.CircleMarker(
         st.session_state.origin,
-        popup="Origin",
-        icon=folium.Icon(color='green', icon='play'),
+        radius=8,
+        color='green',
+        fill=True,
+        fill_opacity=1,
         tooltip="Origin"
-    ).add_to(m)
+    ).add_to(markers)
 
 # Add destination marker if set
 if st.session_state.destination:
-    folium.Marker(
+    folium.CircleMarker(
         st.session_state.destination,
-        popup="Destination",
-        icon=folium.Icon(color='red', icon='stop'),
+        radius=8,
+        color='red',
+        fill=True,
+        fill_opacity=1,
         tooltip="Destination"
-    ).add_to(m)
+    ).add_to(markers)
 
-# Display map and capture clicks
-map_data = st_folium(m, width=700, height=500, key="selection_map")
+# Display map and capture clicks - only the marker layer changes between reruns,
+# so the base map keeps its element ids and the component is not remounted.
+# Only clicks are returned, so panning or zooming does not trigger a rerun.
+map_data = st_folium(
+    m,
+    width=700,
+    height=500,
+    key="selection_map",
+    feature_group_to_add=markers,
+    returned_objects=["last_clicked"]
+)
 
 # Handle map clicks
 if map_data and map_data.get('last_clicked'):
@@ -416,7 +584,10 @@ if map_data and map_data.get('last_clicked'):
         st.session_state.last_clicked = clicked
         lat, lon = clicked['lat'], clicked['lng']
         
-        if not st.session_state.origin:
+        # Reject clicks outside Paris up front, before they can lead to API calls
+        if not in_paris(lat, lon):
+            st.warning(f"⚠️ ({lat:.6f}, {lon:.6f}) is outside Paris - click inside the red boundary.")
+        elif not st.session_state.origin:
             st.session_state.origin = [lat, lon]
             st.success(f"✅ Origin set: ({lat:.6f}, {lon:.6f})")
             st.rerun()
@@ -466,10 +637,28 @@ if st.button("🔍 Compare Routes", type="primary", disabled=not (st.session_sta
         from_coords = tuple(st.session_state.origin)
         to_coords = tuple(st.session_state.destination)
         
-        # Get journeys
-        metro = get_metro_journey(from_coords, to_coords)
-        bike = get_bike_journey(from_coords, to_coords)
-        walking = get_walking_journey(from_coords, to_coords)
+        from_key = round_coords(from_coords)
+        to_key = round_coords(to_coords)
+        
+        # Get journeys - the three API calls are independent, so run them concurrently
+        executor = get_executor()
+        futures = {
+            "Metro": executor.submit(get_metro_journey, from_key, to_key),
+            "E-Bike": executor.submit(get_geovelo_journey, from_key, to_key, "BIKE", GEOVELO_BIKE_DETAILS),
+            "Walking": executor.submit(get_geovelo_journey, from_key, to_key, "PEDESTRIAN")
+        }
+        
+        journeys = {}
+        for label, future in futures.items():
+            try:
+                journeys[label] = future.result()
+            except Exception as e:
+                st.error(f"{label} API error: {e}")
+                journeys[label] = None
+        
+        metro = journeys["Metro"]
+        bike = journeys["E-Bike"]
+        walking = journeys["Walking"]
         
         # Store results in session state
         st.session_state.results = {
@@ -535,20 +724,27 @@ if st.session_state.results:
         # Calculate total bike time including walking (for comparison only)
         total_bike_time = bike['duration_min'] + walk_to_bike_time
         
-        # Calculate all pricing options for each provider
-        all_options = []
-        for provider in BIKE_PROVIDERS.keys():
-            options = calculate_all_bike_costs(bike['duration_min'], provider)  # Cost based on cycling time only
-            for option in options:
-                all_options.append({
-                    **option,
-                    "provider": provider
-                })
-        
-        # Count how many options are cheaper than metro (excluding Velib')
-        cheaper_count = sum(1 for opt in all_options 
-                           if opt['provider'] != "Velib'" and opt['cost'] < METRO_COST)
-        total_count = sum(1 for opt in all_options if opt['provider'] != "Velib'")
+        # Calculate all pricing options for every provider
+        all_options = calculate_all_bike_costs(bike['duration_min'])  # Cost based on cycling time only
+        
+        # Summarize all options in a single pass: how many are cheaper than metro (excluding
+        # Velib'), and whether per-minute (no pass minutes) or any short pass is cheaper than
+        # metro. Options are bucketed by provider on the way.
+        by_provider = defaultdict(list)
+        cheaper_count = 0
+        total_count = 0
+        short_term_cheaper = False
+        for opt in all_options:
+            provider = opt['provider']
+            by_provider[provider].append(opt)
+            cost = opt['cost']
+            if provider != "Velib'":
+                total_count += 1
+                if cost < METRO_COST:
+                    cheaper_count += 1
+                    minutes = opt['minutes']
+                    if minutes is None or minutes < SHORT_PASS_MINUTES:
+                        short_term_cheaper = True
         
         # Display options by provider in columns
         provider_list = list(BIKE_PROVIDERS.keys())
@@ -557,9 +753,7 @@ if st.session_state.results:
         for idx, provider in enumerate(provider_list):
             with cols[idx]:
                 st.markdown(f"### 🚴 {provider}")
-                provider_options = [opt for opt in all_options if opt['provider'] == provider]
-                
-                for option in provider_options:
+                for option in by_provider[provider]:
                     # Determine icon
                     icon = "✅" if option['cost'] < METRO_COST else "❌"
                     
@@ -594,23 +788,7 @@ if st.session_state.results:
         # Comparison and recommendation
         st.header("🎯 Recommendation")
         
-        # Find cheapest option overall
-        cheapest_option = min(all_options, key=lambda x: x['cost'])
-        min_cost = cheapest_option['cost']
-        
-        # Find all providers/options that match the minimum cost (within €0.01)
-        cheapest_providers = list(set([opt['provider'] for opt in all_options if abs(opt['cost'] - min_cost) < 0.01]))
-        
-        # Format provider list
-        if len(cheapest_providers) == 1:
-            provider_text = cheapest_providers[0]
-        elif len(cheapest_providers) == 2:
-            provider_text = f"{cheapest_providers[0]} and {cheapest_providers[1]}"
-        else:
-            provider_text = ", ".join(cheapest_providers[:-1]) + f", and {cheapest_providers[-1]}"
-        
         time_diff = total_bike_time - metro['duration_min']
-        cost_diff = min_cost - metro['cost']
         
         col1, col2 = st.columns(2)
         
@@ -630,241 +808,82 @@ if st.session_state.results:
         # Final recommendation
         st.markdown("---")
         
-        # Check if per-minute or any pass under 60 minutes is cheaper than metro
-        short_term_cheaper = any(
-            opt['cost'] < METRO_COST 
-            for opt in all_options 
-            if opt['provider'] != "Velib'" and (
-                opt['name'] == "Per-minute" or 
-                ('min pass' in opt['name'] and int(opt['name'].split()[0]) < 60)
-            )
-        )
-        
-        recommended_mode = None
         if short_term_cheaper:
             st.success(f"### ✅ Recommended: **E-Bike**")
             st.markdown(f"**{cheaper_count}** practical e-bike options beat metro pricing!")
-            recommended_mode = "bike"
         else:
             st.info("### 🚇 Recommended: **Metro**")
             st.markdown(f"While **{cheaper_count}** e-bike options are cheaper, they require longer-term passes. Metro offers better value for single trips.")
-            recommended_mode = "metro"
         
-        # Route visualization - side by side maps
+        # Route visualization - all routes on one map
         st.markdown("---")
         st.header("🗺️ Route Visualization")
         
-        col1, col2, col3 = st.columns(3)
-        
-        with col1:
-            st.subheader("🚇 Metro Route")
-            metro_map = folium.Map(
-                location=[from_coords[0], from_coords[1]],
-                zoom_start=13,
-                tiles="OpenStreetMap"
-            )
-            
-            folium.Marker(
-                from_coords,
-                popup="Origin",
-                icon=folium.Icon(color='green', icon='play')
-            ).add_to(metro_map)
-            
-            folium.Marker(
-                to_coords,
-                popup="Destination",
-                icon=folium.Icon(color='red', icon='stop')
-            ).add_to(metro_map)
-            
-            # Add metro route with walking sections
-            metro_displayed = False
-            walking_displayed = False
-            if metro.get('sections'):
-                for section in metro['sections']:
-                    section_type = section.get('type')
-                    
-                    # Display public transport sections (purple)
-                    if section_type == 'public_transport':
-                        geojson = section.get('geojson')
-                        if geojson and geojson.get('coordinates'):
-                            try:
-                                coords = geojson['coordinates']
-                                coords = [[c[1], c[0]] for c in coords]
-                                
-                                display_info = section.get('display_informations', {})
-                                line_name = display_info.get('code', 'Metro')
-                                
-                                folium.PolyLine(
-                                    coords,
-                                    color='purple',
-                                    weight=6,
-                                    opacity=0.9,
-                                    popup=f"Line {line_name}"
-                                ).add_to(metro_map)
-                                
-                                metro_displayed = True
-                            except:
-                                pass
-                    
-                    # Display walking sections (green)
-                    elif section_type == 'street_network' or section_type == 'transfer':
-                        geojson = section.get('geojson')
-                        if geojson and geojson.get('coordinates'):
-                            try:
-                                coords = geojson['coordinates']
-                                coords = [[c[1], c[0]] for c in coords]
-                                
-                                folium.PolyLine(
-                                    coords,
-                                    color='green',
-                                    weight=4,
-                                    opacity=0.7,
-                                    dash_array='5, 5',
-                                    popup="Walking"
-                                ).add_to(metro_map)
-                                
-                                walking_displayed = True
-                            except:
-                                pass
-            
-            try:
-                metro_map.fit_bounds([[from_coords[0], from_coords[1]], [to_coords[0], to_coords[1]]])
-            except:
-                pass
-            
-            st_folium(metro_map, width=250, height=400, key="metro_map")
-            if metro_displayed:
-                if walking_displayed:
-                    st.caption("Purple: Metro lines | Green dashed: Walking")
-                else:
-                    st.caption("Purple: Metro lines")
-            else:
-                st.caption("⚠️ Route geometry not available")
-        
-        with col2:
-            st.subheader("🚴 E-Bike Route")
-            bike_map = folium.Map(
-                location=[from_coords[0], from_coords[1]],
-                zoom_start=13,
-                tiles="OpenStreetMap"
-            )
-            
-            folium.Marker(
-                from_coords,
-                popup="Origin",
-                icon=folium.Icon(color='green', icon='play')
-            ).add_to(bike_map)
-            
-            folium.Marker(
-                to_coords,
-                popup="Destination",
-                icon=folium.Icon(color='red', icon='stop')
-            ).add_to(bike_map)
-            
-            # Add bike route
-            bike_displayed = False
-            if bike.get('geometry'):
-                try:
-                    import polyline
-                    geometry_str = bike['geometry']
-                    
-                    if geometry_str:
-                        coordinates = polyline.decode(geometry_str, 6)
-                        
-                        if coordinates and len(coordinates) > 0:
-                            folium.PolyLine(
-                                coordinates,
-                                color='blue',
-                                weight=6,
-                                opacity=0.9,
-                                popup=f"E-Bike: {bike['distance_km']:.2f} km"
-                            ).add_to(bike_map)
-                            
-                            bike_displayed = True
-                except Exception as e:
-                    pass
-            
-            try:
-                bike_map.fit_bounds([[from_coords[0], from_coords[1]], [to_coords[0], to_coords[1]]])
-            except:
-                pass
-            
-            st_folium(bike_map, width=250, height=400, key="bike_map")
-        
-        with col3:
-            st.subheader("🚶 Walking Route")
-            walk_map = folium.Map(
-                location=[from_coords[0], from_coords[1]],
-                zoom_start=13,
-                tiles="OpenStreetMap"
-            )
-            
-            folium.Marker(
-                from_coords,
-                popup="Origin",
-                icon=folium.Icon(color='green', icon='play')
-            ).add_to(walk_map)
-            
-            folium.Marker(
-                to_coords,
-                popup="Destination",
-                icon=folium.Icon(color='red', icon='stop')
-            ).add_to(walk_map)
-            
-            # Add walking route
-            walk_displayed = False
-            if walking and walking.get('geometry'):
-                try:
-                    import polyline
-                    geometry_str = walking['geometry']
-                    
-                    if geometry_str:
-                        coordinates = polyline.decode(geometry_str, 6)
-                        
-                        if coordinates and len(coordinates) > 0:
-                            folium.PolyLine(
-                                coordinates,
-                                color='orange',
-                                weight=6,
-                                opacity=0.9,
-                                popup=f"Walking: {walking['distance_km']:.2f} km"
-                            ).add_to(walk_map)
-                            
-                            walk_displayed = True
-                except Exception as e:
-                    pass
-            
-            try:
-                walk_map.fit_bounds([[from_coords[0], from_coords[1]], [to_coords[0], to_coords[1]]])
-            except:
-                pass
-            
-            st_folium(walk_map, width=250, height=400, key="walk_map")
+        # The map is display-only, so it is shown as static HTML rendered once per trip
+        # rather than through st_folium, which would re-render and sync it on every rerun
+        center, bounds = trip_view(from_coords, to_coords)
+        routes_key = (metro['sections_key'], bike['route_key'], walking['route_key'] if walking else None)
+        results_html, displayed = build_results_map(
+            from_coords, to_coords, center, bounds, routes_key, metro['sections'], bike, walking
+        )
+        st.iframe(results_html, height=500)
+        
+        legend = []
+        if displayed["metro"]:
+            legend.append("Purple: Metro lines")
+        if displayed["metro_walking"]:
+            legend.append("Green dashed: Walking to/from metro")
+        if displayed["bike"]:
+            legend.append("Blue: E-Bike")
+        if displayed["walking"]:
+            legend.append("Orange: Walking")
+        if legend:
+            st.caption(" | ".join(legend) + " - use the layer control to show or hide routes")
+        
+        # Only warn about routes that were found but came back without geometry
+        missing = []
+        if not displayed["metro"] and not displayed["metro_walking"]:
+            missing.append("Metro")
+        if not displayed["bike"]:
+            missing.append("E-Bike")
+        if walking and not displayed["walking"]:
+            missing.append("Walking")
+        if missing:
+            st.caption(f"⚠️ {', '.join(missing)} route geometry not available")
         
         # Detailed breakdown
         with st.expander("📋 Detailed Breakdown"):
-            st.markdown("**Metro Journey:**")
-            st.write(f"- Duration: {metro['duration_min']:.1f} minutes")
-            st.write(f"- Transfers: {metro['transfers']}")
-            st.write(f"- Cost: €{metro['cost']:.2f}")
+            # One markdown block instead of a message per line
+            lines = [
+                "**Metro Journey:**",
+                "",
+                f"- Duration: {metro['duration_min']:.1f} minutes",
+                f"- Transfers: {metro['transfers']}",
+                f"- Cost: €{metro['cost']:.2f}"
+            ]
             if metro.get('origin_station'):
-                st.write(f"- From: {metro['origin_station']}")
+                lines.append(f"- From: {metro['origin_station']}")
             if metro.get('destination_station'):
-                st.write(f"- To: {metro['destination_station']}")
+                lines.append(f"- To: {metro['destination_station']}")
             
-            st.markdown("**E-Bike Journey:**")
-            st.write(f"- Cycling Duration: {bike['duration_min']:.1f} minutes")
-            st.write(f"- Walking to Bike: {walk_to_bike_time:.1f} minutes")
-            st.write(f"- Total Duration: {total_bike_time:.1f} minutes")
-            st.write(f"- Distance: {bike['distance_km']:.2f} km")
-            
-            st.markdown("**E-Bike Pricing Options:**")
+            lines += [
+                "",
+                "**E-Bike Journey:**",
+                "",
+                f"- Cycling Duration: {bike['duration_min']:.1f} minutes",
+                f"- Walking to Bike: {walk_to_bike_time:.1f} minutes",
+                f"- Total Duration: {total_bike_time:.1f} minutes",
+                f"- Distance: {bike['distance_km']:.2f} km",
+                "",
+                "**E-Bike Pricing Options:**"
+            ]
             for provider in BIKE_PROVIDERS.keys():
-                st.write(f"\n**{provider}:**")
-                provider_options = [opt for opt in all_options if opt['provider'] == provider]
-                for option in provider_options:
+                lines += ["", f"**{provider}:**", ""]
+                for option in by_provider[provider]:
                     icon = "✅" if option['cost'] < METRO_COST else "❌"
-                    st.write(f"  {icon} {option['name']}: €{option['cost']:.2f}")
+                    lines.append(f"- {icon} {option['name']}: €{option['cost']:.2f}")
+            
+            st.markdown("\n".join(lines))
     
     elif not metro:
         st.error("❌ Could not calculate metro route")
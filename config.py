@@ -2,9 +2,14 @@
 Pricing configuration for Paris transport options
 """
 
+import numpy as np
+
 # Metro pricing
 METRO_COST = 2.50  # € per trip
 
+# Passes shorter than this count as practical for a single trip in the recommendation
+SHORT_PASS_MINUTES = 60
+
 # E-bike providers pricing
 BIKE_PROVIDERS = {
     "Voi": {
@@ -46,11 +51,99 @@ BIKE_PROVIDERS = {
     }
 }
 
+# Flattened pricing options (one entry per option, in display order) so costs for
+# every provider can be computed in a single vectorized pass
+# kind: "per_minute", "bundle" (prorated pass minutes), "single" or "multi" (Velib' trips)
+PRICING_OPTIONS = []
+for provider, pricing in BIKE_PROVIDERS.items():
+    if pricing["per_minute"] is not None:
+        PRICING_OPTIONS.append({
+            "provider": provider,
+            "name": "Per-minute",
+            "kind": "per_minute",
+            "unlock": pricing["unlock"],
+            "per_minute": pricing["per_minute"]
+        })
+    for pass_option in pricing["passes"]:
+        PRICING_OPTIONS.append({
+            "provider": provider,
+            "name": pass_option.get("name", f"{pass_option['minutes']} min pass"),
+            "kind": pass_option.get("type", "bundle"),
+            "per_minute": pricing["per_minute"] or 0.0,
+            "minutes": pass_option["minutes"],
+            "cost": pass_option["cost"],
+            "trips": pass_option.get("trips", 1),
+            "overage_per_30min": pass_option.get("overage_per_30min", 0.0)
+        })
+
+OPTION_PROVIDER = [opt["provider"] for opt in PRICING_OPTIONS]
+OPTION_NAME = [opt["name"] for opt in PRICING_OPTIONS]
+OPTION_PASS_MINUTES = [opt.get("minutes") for opt in PRICING_OPTIONS]  # None for per-minute
+OPTION_KIND = np.array([opt["kind"] for opt in PRICING_OPTIONS])
+OPTION_UNLOCK = np.array([opt.get("unlock", 0.0) for opt in PRICING_OPTIONS], dtype=np.float64)
+OPTION_PER_MINUTE = np.array([opt["per_minute"] for opt in PRICING_OPTIONS], dtype=np.float64)
+OPTION_MINUTES = np.array([opt.get("minutes", 0) for opt in PRICING_OPTIONS], dtype=np.float64)
+OPTION_COST = np.array([opt.get("cost", 0.0) for opt in PRICING_OPTIONS], dtype=np.float64)
+OPTION_TRIPS = np.array([opt.get("trips", 1) for opt in PRICING_OPTIONS], dtype=np.float64)
+OPTION_OVERAGE = np.array([opt.get("overage_per_30min", 0.0) for opt in PRICING_OPTIONS], dtype=np.float64)
+
+# Derived per-option constants, so the pricing kernel does no per-call setup
+OPTION_IS_BUNDLE = OPTION_KIND == "bundle"
+OPTION_IS_TRIP_PASS = (OPTION_KIND == "single") | (OPTION_KIND == "multi")
+OPTION_RATE = np.divide(OPTION_COST, OPTION_MINUTES, out=np.zeros_like(OPTION_COST), where=OPTION_IS_BUNDLE)  # € per pass minute
+OPTION_TRIP_COST = OPTION_COST / OPTION_TRIPS  # € per Velib' trip
+OPTION_REMAINING_TYPE = [
+    "minutes" if is_bundle else "trips" if is_trip_pass else None
+    for is_bundle, is_trip_pass in zip(OPTION_IS_BUNDLE, OPTION_IS_TRIP_PASS)
+]
+
+# Paris boundary polygon
+PARIS_BOUNDARY = {
+    "type": "Feature",
+    "geometry": {
+        "type": "Polygon",
+        "coordinates": [[[2.3198871747441,48.90045978209],[2.3851496429397,48.902007785215],[2.394906293421,48.898444039523],[2.3988455271816,48.887109095072],[2.4132702557262,48.872892145992],[2.4163411302989,48.849233783552],[2.4122456125626,48.834538914673],[2.4221386362435,48.835797660955],[2.4281301699852,48.841528392473],[2.447699326814,48.844818443355],[2.4634383121686,48.842089485269],[2.4675819883673,48.833133318793],[2.4626960627524,48.819059770564],[2.4384475102742,48.818232447877],[2.406031823401,48.827615470779],[2.3909392530738,48.826078980076],[2.363946550191,48.816314210034],[2.3318980606376,48.817010929642],[2.2921959226619,48.82714160912],[2.2790519306533,48.832489952145],[2.2727931901868,48.827920084226],[2.2551442384175,48.834809549369],[2.2506124417162,48.845554851211],[2.2242191058804,48.853516917557],[2.2317363597469,48.86906858161],[2.2584671711142,48.880387263086],[2.2774870298138,48.877968320853],[2.2915068524977,48.8894718708],[2.3198871747441,48.90045978209]]]
+    },
+    "properties": {"code": "75", "nom": "Paris"}
+}
+
+# Boundary ring as (lat, lon) tuples in the order folium expects, computed once at import
+PARIS_BOUNDARY_LATLON = tuple((lat, lon) for lon, lat in PARIS_BOUNDARY["geometry"]["coordinates"][0])
+
+# Boundary edges as start/end (lat, lon) arrays for the vectorized point-in-Paris check on clicks
+PARIS_EDGE_START = np.array(PARIS_BOUNDARY_LATLON[:-1])
+PARIS_EDGE_END = np.array(PARIS_BOUNDARY_LATLON[1:])
+
 # Geovelo API settings
 GEOVELO_BIKE_PROFILE = "MEDIAN"
 GEOVELO_EBIKE = True  # All providers use electric bikes
 GEOVELO_BIKE_TYPE = "BSS"  # Bike sharing system
+GEOVELO_BIKE_DETAILS = {
+    "profile": GEOVELO_BIKE_PROFILE,
+    "bikeType": GEOVELO_BIKE_TYPE,
+    "eBike": GEOVELO_EBIKE
+}
+GEOVELO_PARAMS = {
+    "instructions": "false",
+    "elevations": "false",
+    "geometry": "true",
+    "single_result": "true"
+}
+
+# Route simplification tolerance in degrees (~1 m) - vertices closer than this to the
+# simplified line are dropped before drawing, with no visible change at city zoom levels
+ROUTE_SIMPLIFY_TOLERANCE = 1e-5
+
+# Map tiles - a folium tileset name, or a "{z}/{x}/{y}" URL template (which then needs
+# MAP_TILES_ATTR) to serve tiles from a caching mirror instead of tile.openstreetmap.org
+MAP_TILES = "OpenStreetMap"
+MAP_TILES_ATTR = None
 
 # API endpoints
 NAVITIA_ENDPOINT = "https://prim.iledefrance-mobilites.fr/marketplace/v2/navitia"
 GEOVELO_ENDPOINT = "https://prim.iledefrance-mobilites.fr/marketplace/computedroutes"
+
+# Worker pool shared by all sessions for the API calls - each comparison makes three
+# concurrent calls, so this many comparisons can run at once without queueing
+MAX_CONCURRENT_COMPARISONS = 8
+API_WORKERS = 3 * MAX_CONCURRENT_COMPARISONS
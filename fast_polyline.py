@@ -0,0 +1,56 @@
+"""
+Encoded polyline decoding for route geometries
+"""
+
+import numpy as np
+
+try:
+    from pypolyline.cutil import decode_polyline as _pypolyline_decode
+except ImportError:  # no compiled decoder available, fall back to the NumPy decoder
+    _pypolyline_decode = None
+
+def decode_to_array(geometry, precision=6):
+    """Decode an encoded polyline into a preallocated (N, 2) array of (lat, lon) rows
+    
+    Every value is a run of 5-bit chunks (least significant first) whose last chunk lacks
+    the 0x20 continuation flag. Counting those terminators sizes the output up front, then
+    all values are assembled at once with a segmented OR, zigzag-decoded, and prefix-summed
+    from deltas to absolute coordinates straight into the output buffer.
+    Raises ValueError on malformed input, including overlong values (a 32-bit value needs
+    at most 7 chunks) and coordinates outside the valid latitude/longitude range.
+    """
+    chunks = np.frombuffer(geometry.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if chunks.size == 0:
+        return np.empty((0, 2))
+    if chunks.min() < 0 or chunks.max() > 63 or chunks[-1] & 0x20:
+        raise ValueError("Malformed polyline")
+    
+    ends = np.flatnonzero(chunks < 0x20)
+    if len(ends) % 2:
+        raise ValueError("Malformed polyline")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    if (ends - starts).max() >= 7:
+        raise ValueError("Malformed polyline")
+    coords = np.empty((len(ends) // 2, 2), dtype=np.float64)
+    
+    shifts = 5 * (np.arange(chunks.size) - np.repeat(starts, ends - starts + 1))
+    values = np.bitwise_or.reduceat((chunks & 0x1f) << shifts, starts)
+    deltas = (values >> 1) ^ -(values & 1)
+    
+    np.cumsum(deltas.reshape(-1, 2), axis=0, out=coords)
+    coords /= 10.0 ** precision
+    if np.abs(coords[:, 0]).max() > 90 or np.abs(coords[:, 1]).max() > 180:
+        raise ValueError("Malformed polyline")
+    return coords
+
+def decode_polyline(geometry, precision=6):
+    """Decode an encoded polyline to an (N, 2) array of (lat, lon) rows
+    
+    Uses the compiled pypolyline decoder when installed, otherwise decode_to_array.
+    Raises ValueError (NumPy decoder) or RuntimeError (pypolyline) on malformed input.
+    """
+    if _pypolyline_decode is not None:
+        # pypolyline returns [lon, lat] pairs
+        lonlat = np.array(_pypolyline_decode(geometry.encode(), precision), dtype=np.float64).reshape(-1, 2)
+        return lonlat[:, ::-1]
+    return decode_to_array(geometry, precision)